@@ -1,8 +1,8 @@
 import os
-import json
 import logging
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import orjson
 from src.extractor import extract_outline_from_pdf
 
 # Configure structured logging for production environments
@@ -13,12 +13,23 @@ logging.basicConfig(
 INPUT_DIR = Path("/app/input")
 OUTPUT_DIR = Path("/app/output")
 
+# Output directory of a worker process, set once by _init_worker.
+_worker_output_dir = None
 
-def process_single_pdf(pdf_path: Path, output_dir: Path) -> bool:
+
+def _init_worker(output_dir: str) -> None:
+    """Executor initializer: binds the output directory once per worker process."""
+    global _worker_output_dir
+    _worker_output_dir = Path(output_dir)
+
+
+def process_single_pdf(pdf_file: str) -> bool:
     """
     Worker function to process and save a single PDF outline.
+    Takes the PDF path as a plain string to keep task pickling minimal.
     Returns True on success, False on failure.
     """
+    pdf_path = Path(pdf_file)
     logging.info(f"Starting processing: {pdf_path.name}")
     try:
         # 1. Extract outline data
@@ -26,9 +37,10 @@ def process_single_pdf(pdf_path: Path, output_dir: Path) -> bool:
 
         # 2. Write output file directly from the worker process
         if outline_data and outline_data["outline"]:
-            output_filename = output_dir / f"{pdf_path.stem}.json"
-            with open(output_filename, "w", encoding="utf-8") as f:
-                json.dump(outline_data, f, ensure_ascii=False, indent=4)
+            output_filename = _worker_output_dir / f"{pdf_path.stem}.json"
+            output_filename.write_bytes(
+                orjson.dumps(outline_data, option=orjson.OPT_INDENT_2)
+            )
             logging.info(f"Successfully processed and saved: {pdf_path.name}")
             return True
         else:
@@ -40,13 +52,30 @@ def process_single_pdf(pdf_path: Path, output_dir: Path) -> bool:
         return False
 
 
+def find_pdf_files(input_dir: Path) -> list[str]:
+    """
+    Lists the non-empty PDF files in a directory, largest first, so the
+    slowest documents are scheduled before the pool drains.
+    """
+    if not input_dir.is_dir():
+        return []
+    with os.scandir(input_dir) as entries:
+        sized_files = [
+            (entry.stat().st_size, entry.path)
+            for entry in entries
+            if entry.name.endswith(".pdf") and entry.is_file()
+        ]
+    sized_files.sort(reverse=True)
+    return [path for size, path in sized_files if size > 0]
+
+
 def main():
     """
     Main entry point. Finds all PDF files and processes them in parallel.
     Each worker process now handles its own JSON file output.
     """
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    pdf_files = list(INPUT_DIR.glob("*.pdf"))
+    pdf_files = find_pdf_files(INPUT_DIR)
 
     if not pdf_files:
         logging.warning("No PDF files found in /app/input. Exiting.")
@@ -58,13 +87,17 @@ def main():
     )
 
     success_count = 0
-    with ProcessPoolExecutor(max_workers=num_cores) as executor:
-        # Map each pdf file to the worker function, providing the output directory
-        results = executor.map(
-            process_single_pdf, pdf_files, [OUTPUT_DIR] * len(pdf_files)
-        )
-        # Sum the boolean results to get the total success count
-        success_count = sum(1 for r in results if r)
+    # Files are submitted largest first and results are consumed as they finish.
+    # A crashed worker surfaces as BrokenProcessPool instead of hanging the run.
+    with ProcessPoolExecutor(
+        max_workers=num_cores, initializer=_init_worker, initargs=(str(OUTPUT_DIR),)
+    ) as executor:
+        futures = [
+            executor.submit(process_single_pdf, pdf_file) for pdf_file in pdf_files
+        ]
+        for future in as_completed(futures):
+            if future.result():
+                success_count += 1
 
     logging.info(
         f"Processing complete. {success_count}/{len(pdf_files)} outlines generated."
@@ -1,72 +1,94 @@
 import fitz  # PyMuPDF
+import heapq
 import re
 import json
 from pathlib import Path
 from collections import Counter
+from operator import itemgetter
 
 # Load and compile expensive resources once at module load
 with open("config.json", "r") as f:
     CONFIG = json.load(f)
 
 HEADING_STRUCTURE_PATTERN = re.compile(CONFIG["HEADING_STRUCTURE_REGEX"])
+MIN_HEADING_WORDS = CONFIG["MIN_HEADING_WORDS"]
+MAX_HEADING_WORDS = CONFIG["MAX_HEADING_WORDS"]
+MAX_HEADING_LEVELS = CONFIG["MAX_HEADING_LEVELS"]
+# Output labels indexed by numeric heading level ("H1", "H2", ...).
+LEVEL_LABELS = tuple(f"H{level}" for level in range(MAX_HEADING_LEVELS + 1))
+
+# Text-only extraction: image blocks and ligature preservation are never used
+# by the heuristics, so leave them out of the extracted dict tree.
+TEXT_EXTRACTION_FLAGS = (
+    fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES & ~fitz.TEXT_PRESERVE_LIGATURES
+)
+
+# Drawing operations that can form table ruling lines (see Page.get_bboxlog).
+VECTOR_PATH_KINDS = frozenset(("fill-path", "stroke-path"))
 
 
 def clean_text(text: str) -> str:
     """Removes redundant whitespace from a string."""
-    return re.sub(r"\s+", " ", text).strip()
+    return " ".join(text.split())
 
 
-def get_style_key(span: dict) -> tuple:
+def get_style_key(font_size: int, font_name: str, flags: int) -> tuple:
     """Creates a unique, hashable key representing the visual style of a text span."""
-    font_size = round(span["size"])
-    font_name = span["font"].split("+")[-1].lower()
-    is_bold = "bold" in font_name or (span["flags"] & 2**4)
+    # Strip the subset prefix ("ABCDEF+"), which differs across merged or
+    # per-page-subset documents for the same face.
+    font_name = font_name[font_name.rfind("+") + 1 :]
+    # The bold flag is cheap to test; only fall back to the font name when unset.
+    is_bold = bool(flags & 2**4) or "bold" in font_name.lower()
     return (font_size, font_name, is_bold)
 
 
-def _is_within_any_bbox(
-    element_bbox: fitz.Rect, container_bboxes: list[fitz.Rect]
-) -> bool:
-    """Checks if an element's bounding box is inside any of the container bboxes."""
-    for bbox in container_bboxes:
-        if element_bbox in bbox:
+def _is_within_any_bbox(element_bbox: tuple, container_bboxes: list[tuple]) -> bool:
+    """
+    Checks if an element's bounding box is inside any of the container bboxes.
+    Both are plain (x0, y0, x1, y1) tuples, as returned for table bboxes by
+    find_tables(), so containment is compared coordinate by coordinate.
+    """
+    x0, y0, x1, y1 = element_bbox
+    for cx0, cy0, cx1, cy1 in container_bboxes:
+        if cx0 <= x0 and cy0 <= y0 and x1 <= cx1 and y1 <= cy1:
             return True
     return False
 
 
-def _is_potential_heading(line, block, body_size, config) -> tuple[bool, str, tuple]:
+def _find_table_bboxes(page: fitz.Page) -> list[tuple]:
     """
-    Applies a series of heuristic filters to a line of text to see if it's a heading.
-    Returns:
-        A tuple of (is_heading, cleaned_text, style_key).
+    Detects tables on a page and returns their bounding boxes.
+    Table detection relies on ruling lines, so pages without any vector paths
+    are skipped without running the (expensive) table finder.
     """
-    if not line.get("spans"):
-        return False, None, None
+    if not any(kind in VECTOR_PATH_KINDS for kind, _ in page.get_bboxlog()):
+        return []
+    return [tuple(table.bbox) for table in page.find_tables()]
 
-    # Reconstruct and clean text from all spans in the line
-    line_text = clean_text(" ".join(s["text"] for s in line["spans"]))
-    if not line_text:
-        return False, None, None
 
-    # All style decisions for the line are based on its first span
-    style = get_style_key(line["spans"][0])
-    font_size = style[0]
+def _is_potential_heading(raw_text: str) -> tuple[bool, str]:
+    """
+    Applies the text-based heuristic filters to a line that already passed the
+    font-size and block-length checks.
+    Returns:
+        A tuple of (is_heading, cleaned_text).
+    """
+    line_text = clean_text(raw_text)
+    if not line_text:
+        return False, None
 
     # --- HEADING FILTERS ---
-    # 1. Must be visually distinct: font size must be larger than the main body text.
-    if font_size <= body_size:
-        return False, None, None
-
-    # 2. Must be concise: headings are typically in blocks with very few lines.
-    if len(block.get("lines", [])) > 2:
-        return False, None, None
-
-    # 3. Must have a plausible length: word count must be within configured limits.
+    # 1. Must have a plausible length: word count must be within configured limits.
     word_count = len(line_text.split())
-    if not (config["MIN_HEADING_WORDS"] <= word_count <= config["MAX_HEADING_WORDS"]):
-        return False, None, None
+    if not (MIN_HEADING_WORDS <= word_count <= MAX_HEADING_WORDS):
+        return False, None
+
+    # 2. Must carry text beyond structural numbering (e.g. "1.2", "IV", "三").
+    line_text = HEADING_STRUCTURE_PATTERN.sub("", line_text).strip()
+    if not line_text:
+        return False, None
 
-    return True, line_text, style
+    return True, line_text
 
 
 def extract_from_layout(doc: fitz.Document):
@@ -74,113 +96,148 @@ def extract_from_layout(doc: fitz.Document):
     Extracts an outline by performing multi-pass analysis on visual styles,
     filtering out tables and non-heading text structures.
     """
-    # Pass 1: Profile document font sizes and detect all tables to create exclusion zones.
+    # Pass 1: Profile document font sizes in a single traversal, detecting tables
+    # to create exclusion zones and caching candidate lines for the heading pass.
+    # Only the fields Pass 2 reads are cached, so no page's dict tree outlives
+    # its iteration.
     font_size_counts = Counter()
-    table_bboxes_by_page = [
-        [table.bbox for table in page.find_tables()] for page in doc
-    ]
-
-    for page_num, page in enumerate(doc):
+    cached_lines = []
+    for page_num in range(doc.page_count):
+        page = doc.load_page(page_num)
+        table_bboxes = _find_table_bboxes(page)
         # Process only text blocks outside of any detected table area
-        for block in page.get_text("dict").get("blocks", []):
-            if block.get("type") == 0 and not _is_within_any_bbox(
-                fitz.Rect(block["bbox"]), table_bboxes_by_page[page_num]
-            ):
-                for line in block.get("lines", []):
-                    if line.get("spans"):
-                        size = round(line["spans"][0]["size"])
-                        font_size_counts[size] += 1
+        blocks = page.get_text("dict", flags=TEXT_EXTRACTION_FLAGS)["blocks"]
+        for block in blocks:
+            if table_bboxes and _is_within_any_bbox(block["bbox"], table_bboxes):
+                continue
+            lines = block.get("lines", [])
+            # Headings must be concise: only lines of short blocks are candidates.
+            is_short_block = len(lines) <= 2
+            for line in lines:
+                spans = line.get("spans")
+                if not spans:
+                    continue
+                # All style decisions for the line are based on its first span
+                first_span = spans[0]
+                size = round(first_span["size"])
+                font_size_counts[size] += 1
+                if is_short_block:
+                    # Reconstruct line text from its spans; most lines have one.
+                    if len(spans) == 1:
+                        raw_text = first_span["text"]
+                    else:
+                        raw_text = " ".join([s["text"] for s in spans])
+                    cached_lines.append(
+                        (
+                            page_num,
+                            size,
+                            line["bbox"][1],
+                            first_span["font"],
+                            first_span["flags"],
+                            raw_text,
+                        )
+                    )
+        # Drop the page so PyMuPDF can free its C-side resources right away.
+        del page
     if not font_size_counts:
         return []
 
     body_size = font_size_counts.most_common(1)[0][0]
 
-    # Pass 2: Identify potential headings using the heuristic helper function.
+    # Pass 2: Identify potential headings among the cached lines.
+    # Each distinct heading style is interned to an integer id so later set and
+    # dict operations hash a small int instead of the full style tuple.
     potential_headings = []
-    heading_styles = set()
-    for page_num, page in enumerate(doc):
-        for block in page.get_text("dict").get("blocks", []):
-            # Skip non-text blocks and blocks inside tables
-            if block.get("type") != 0 or _is_within_any_bbox(
-                fitz.Rect(block["bbox"]), table_bboxes_by_page[page_num]
-            ):
-                continue
-            for line in block.get("lines", []):
-                is_heading, text, style = _is_potential_heading(
-                    line, block, body_size, CONFIG
-                )
-                if is_heading:
-                    potential_headings.append(
-                        {
-                            "text": text,
-                            "style": style,
-                            "page": page.number,
-                            "y_pos": line["bbox"][1],
-                        }
-                    )
-                    heading_styles.add(style)
+    style_ids = {}
+    for page_number, size, y_pos, font_name, flags, raw_text in cached_lines:
+        # Must be visually distinct: font size must be larger than the main body
+        # text. Most lines are body text, so this cheap check comes first.
+        if size <= body_size:
+            continue
+        is_heading, text = _is_potential_heading(raw_text)
+        if is_heading:
+            style = get_style_key(size, font_name, flags)
+            potential_headings.append(
+                {
+                    "text": text,
+                    "style": style_ids.setdefault(style, len(style_ids)),
+                    "page": page_number,
+                    "y_pos": y_pos,
+                }
+            )
+    del cached_lines
     if not potential_headings:
         return []
 
     # Pass 3: Rank styles and build the final outline.
-    ranked_styles = sorted(
-        list(heading_styles), key=lambda s: (s[0], s[2]), reverse=True
+    styles = list(style_ids)  # indexed by style id
+    ranked_styles = heapq.nlargest(
+        MAX_HEADING_LEVELS,
+        range(len(styles)),
+        key=lambda i: (styles[i][0], styles[i][2]),
     )
-    style_to_level = {
-        style: i + 1
-        for i, style in enumerate(ranked_styles[: CONFIG["MAX_HEADING_LEVELS"]])
-    }
+    style_to_level = {style: i + 1 for i, style in enumerate(ranked_styles)}
 
     outline = []
     for h in potential_headings:
         if h["style"] in style_to_level:
-            text = HEADING_STRUCTURE_PATTERN.sub("", h["text"]).strip()
-            if text:
-                outline.append(
-                    {
-                        "level": style_to_level[h["style"]],
-                        "text": text,
-                        "page": h["page"],
-                        "y_pos": h["y_pos"],
-                    }
-                )
+            outline.append(
+                {
+                    "level": style_to_level[h["style"]],
+                    "text": h["text"],
+                    "page": h["page"],
+                    "y_pos": h["y_pos"],
+                }
+            )
 
     if not outline:
         return []
 
     # Final post-processing and formatting
-    outline.sort(key=lambda x: (x["page"], x["y_pos"]))
+    # Pages arrive in order, but blocks within a page follow the content stream,
+    # so a sort on vertical position is still needed.
+    outline.sort(key=itemgetter("page", "y_pos"))
     for i in range(1, len(outline)):
         if outline[i]["level"] > outline[i - 1]["level"] + 1:
             outline[i]["level"] = outline[i - 1]["level"] + 1
 
-    for item in outline:
-        item["level"] = f"H{item['level']}"
-        del item["y_pos"]
+    return [
+        {"level": LEVEL_LABELS[h["level"]], "text": h["text"], "page": h["page"]}
+        for h in outline
+    ]
 
-    return outline
+
+def _is_usable_toc(toc: list) -> bool:
+    """
+    Checks whether an embedded TOC is worth trusting. A lone entry pointing at
+    the first page is usually just a cover bookmark, not a real outline.
+    """
+    if len(toc) > 1:
+        return True
+    return bool(toc) and toc[0][2] > 1
 
 
 def extract_outline_from_pdf(pdf_path: Path) -> dict:
     """
     Extracts a structured outline from a PDF using a hybrid strategy.
-    It first attempts to use the embedded Table of Contents. If unavailable, it
-    falls back to the advanced layout analysis engine.
+    It first attempts to use the embedded Table of Contents. If unavailable (or
+    trivial), it falls back to the advanced layout analysis engine, keeping a
+    trivial TOC only when layout analysis finds nothing.
     """
     with fitz.open(pdf_path) as doc:
         title = doc.metadata.get("title", "") or pdf_path.stem.replace("_", " ").title()
 
         toc = doc.get_toc()
-        if toc:
+        outline = [] if _is_usable_toc(toc) else extract_from_layout(doc)
+        # A trivial TOC is still better than no outline at all.
+        if not outline:
             outline = [
                 {
-                    "level": f"H{min(level, CONFIG['MAX_HEADING_LEVELS'])}",
+                    "level": LEVEL_LABELS[min(level, MAX_HEADING_LEVELS)],
                     "text": clean_text(heading_text),
                     "page": page_num - 1,
                 }
                 for level, heading_text, page_num in toc
             ]
-        else:
-            outline = extract_from_layout(doc)
 
     return {"title": clean_text(title), "outline": outline}